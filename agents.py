@@ -1,8 +1,15 @@
 # agent.py
 import os
 import json
+import logging
 import asyncio
+import contextlib
 import random
+import re
+import time
+from collections import OrderedDict, deque
+import httpx
+import openai
 from openai import AsyncOpenAI  # Use AsyncOpenAI for async compatibility with poke-env
 
 # Import necessary poke-env components for type hinting and functionality
@@ -10,31 +17,180 @@ from poke_env.player import Player
 from poke_env.environment.battle import Battle
 from poke_env.environment.move import Move
 from poke_env.environment.pokemon import Pokemon
-from tools import toolsList
+from poke_env.environment.side_condition import STACKABLE_CONDITIONS
+from tools import ACT_TOOL_CHOICE, ACT_TOOL_NAME, build_act_tool
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler()) # The application decides where (and whether) agent logs go
+
+SYSTEM_PROMPT = (
+    "You are a skilled Pokemon battle AI. Your goal is to win the battle. "
+    "Based on the current battle state, decide the best action: either use an available move or switch to an available Pokémon. "
+    "Consider type matchups, HP, status conditions, field effects, entry hazards, and potential opponent actions. "
+    "Only choose actions listed as available."
+)
+USER_PROMPT_PREFIX = "Choose the best action by calling the 'act' function with kind 'move' or 'switch'.\n\nCurrent Battle State:\n"
+
+# Static system message, built once and shared by every agent. Keeping it byte-identical
+# across turns lets OpenAI's automatic prompt caching reuse the prefill; the battle
+# state goes at the end of the user message.
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+# Strips the separators that differ between display names and poke-env ids
+# ("U-turn" -> "uturn", "Mr. Mime" -> "mrmime") in a single translate pass
+_NORMALIZE_TABLE = str.maketrans("", "", " -_'.")
+# Number of battle positions whose decisions each agent remembers
+DECISION_CACHE_SIZE = 512
+
+def _build_indices(battle: Battle) -> tuple[dict[str, Move], dict[str, Pokemon]]:
+    """Indexes the legal moves by id and the legal switches by normalized species."""
+    return (
+        {m.id: m for m in battle.available_moves},
+        {p.species.lower().translate(_NORMALIZE_TABLE): p for p in battle.available_switches},
+    )
+
+# One OpenAI client (and httpx connection pool) for every agent in the process,
+# so new agents reuse warm keep-alive connections instead of paying a fresh TLS handshake.
+_OAI_CLIENT: AsyncOpenAI | None = None
+
+def get_openai_client() -> AsyncOpenAI:
+    """Returns the shared AsyncOpenAI client, creating it on first use."""
+    global _OAI_CLIENT
+    if _OAI_CLIENT is None:
+        api_key = os.environ.get("OPENAI_API_KEY")
+        if not api_key:
+            raise ValueError("OPENAI_API_KEY environment variable not set or loaded.")
+        _OAI_CLIENT = AsyncOpenAI(
+            api_key=api_key,
+            http_client=httpx.AsyncClient(
+                http2=True, # Multiplex concurrent turn decisions over one connection
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+                timeout=httpx.Timeout(30.0, connect=5.0),
+            ),
+            max_retries=0, # Retries are handled by _api_request
+        )
+    return _OAI_CLIENT
+
+# Ceiling on simultaneous OpenAI requests shared by every battle in the process
+_API_SEM = asyncio.Semaphore(int(os.getenv("OPENAI_MAX_CONCURRENCY", "16")))
+_MAX_API_ATTEMPTS = 5
+_RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+# Longest a turn sleeps before a request (budget reset or backoff); past it the agent
+# falls back to a random move instead of running into Showdown's turn timer
+_MAX_API_WAIT = 5.0
+# When the last response reported no remaining requests, wait until this time.monotonic() value
+_rate_limit_resume_at = 0.0
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+
+class _RateLimitWaitTooLong(Exception):
+    """The request budget resets too far in the future to wait for it this turn."""
+
+def _parse_reset_duration(value: str) -> float:
+    """Parses an OpenAI rate-limit reset header such as '6m0s' or '20ms' into seconds."""
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in _DURATION_PART.findall(value))
+
+def _record_rate_limit(headers) -> None:
+    """Remembers when to resume if the response says the request budget is exhausted."""
+    global _rate_limit_resume_at
+    if headers.get("x-ratelimit-remaining-requests") == "0":
+        reset = _parse_reset_duration(headers.get("x-ratelimit-reset-requests", ""))
+        _rate_limit_resume_at = max(_rate_limit_resume_at, time.monotonic() + reset)
+
+@contextlib.asynccontextmanager
+async def _api_request(client: AsyncOpenAI, **kwargs):
+    """
+    Creates a chat completion and yields it while holding an _API_SEM permit, retrying
+    rate-limit, connection and server errors with capped exponential backoff. Waiting
+    (for a budget reset or a backoff) happens without a permit, so a rate-limited burst
+    doesn't hold up every other battle. Raises _RateLimitWaitTooLong rather than
+    waiting out a budget that resets more than _MAX_API_WAIT from now.
+    """
+    for attempt in range(_MAX_API_ATTEMPTS):
+        delay = _rate_limit_resume_at - time.monotonic()
+        if delay > _MAX_API_WAIT:
+            raise _RateLimitWaitTooLong(f"request budget resets in {delay:.0f}s")
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with _API_SEM:
+            try:
+                raw_response = await client.chat.completions.with_raw_response.create(**kwargs)
+            except _RETRYABLE_ERRORS as e:
+                if attempt == _MAX_API_ATTEMPTS - 1:
+                    raise
+                error = e
+            else:
+                _record_rate_limit(raw_response.headers)
+                yield raw_response.parse()
+                return
+        backoff = min(_MAX_API_WAIT, 2 ** attempt + random.random())
+        logger.warning("OpenAI request failed (%s); retrying in %.1fs", error, backoff)
+        await asyncio.sleep(backoff)
 
 class OpenAIAgent(Player):
     """
     An AI agent for Pokemon Showdown that uses OpenAI's API
-    with function calling to decide its moves.
+    with a single constrained tool call to decide its moves.
     Requires OPENAI_API_KEY environment variable to be set.
     """
+    # Player itself has no __slots__, so instances keep a __dict__; these still get
+    # fast slot descriptors for the attributes read on every turn.
+    __slots__ = ("openai_client", "model", "_system_msg", "battle_history", "_env_cache", "_decision_cache")
+
     def __init__(self, *args, **kwargs):
         # Pass account_configuration and other Player args/kwargs to the parent
         super().__init__(*args, **kwargs)
 
-        # Initialize OpenAI client
-        # It's slightly better practice to get the key here rather than relying solely on the global env scope
-        api_key = os.environ["OPENAI_API_KEY"]
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY environment variable not set or loaded.")
+        # Use the shared AsyncOpenAI client (async for compatibility with poke-env's async nature)
+        self.openai_client = get_openai_client()
+        self.model = os.getenv("POKE_AGENT_MODEL", "gpt-4o-mini") # Or "gpt-4o", "gpt-4-turbo", etc.
+
+        self._system_msg = _SYSTEM_MSG
+        self.battle_history = deque(maxlen=32) # Optional: To potentially add context later (bounded)
+        # (weather, fields, side conditions) snapshot and its formatted string, reused while unchanged
+        self._env_cache: tuple[tuple, str] | None = None
+        # LRU of canonical battle position -> validated decision, to skip the API on repeats
+        self._decision_cache: OrderedDict[tuple, dict] = OrderedDict()
 
-        # Use AsyncOpenAI for compatibility with poke-env's async nature
-        self.openai_client = AsyncOpenAI(api_key=api_key)
-        self.model = "gpt-4o" # Or "gpt-3.5-turbo", "gpt-4-turbo-preview", etc.
+    @staticmethod
+    def _pokemon_key(pkmn: Pokemon) -> tuple:
+        """Canonical, hashable summary of a Pokemon for the decision cache."""
+        return (
+            pkmn.species,
+            int(pkmn.current_hp_fraction * 10), # HP in 10% buckets
+            pkmn.status,
+            tuple(sorted(pkmn.boosts.items())),
+        )
+
+    @staticmethod
+    def _side_conditions_key(side_conditions: dict) -> frozenset:
+        """
+        Side conditions for the decision cache. poke-env stores the turn a condition started
+        as its value (a layer count for Spikes / Toxic Spikes), so only layers are kept.
+        """
+        return frozenset(
+            (condition, value if condition in STACKABLE_CONDITIONS else None)
+            for condition, value in side_conditions.items()
+        )
 
-        # Define the functions OpenAI can "call"
-        self.functions = toolsList
-        self.battle_history = [] # Optional: To potentially add context later
+    def _decision_cache_key(self, battle: Battle) -> tuple:
+        """Builds the key identifying a battle position for the decision cache."""
+        return (
+            self._pokemon_key(battle.active_pokemon),
+            self._pokemon_key(battle.opponent_active_pokemon),
+            tuple(sorted(m.id for m in battle.available_moves)),
+            tuple(sorted(p.species for p in battle.available_switches)),
+            frozenset(battle.weather),
+            frozenset(battle.fields),
+            self._side_conditions_key(battle.side_conditions),
+            self._side_conditions_key(battle.opponent_side_conditions),
+        )
+
+    def _cache_decision(self, key: tuple, decision: dict) -> None:
+        """Stores a decision that produced a valid order, evicting the oldest entry when full."""
+        self._decision_cache[key] = decision
+        self._decision_cache.move_to_end(key)
+        if len(self._decision_cache) > DECISION_CACHE_SIZE:
+            self._decision_cache.popitem(last=False)
 
     def _format_battle_state(self, battle: Battle) -> str:
         """Formats the current battle state into a string for the LLM."""
@@ -54,146 +210,175 @@ class OpenAIAgent(Player):
                              f"Status: {opponent_pkmn.status.name if opponent_pkmn.status else 'None'} " \
                              f"Boosts: {opponent_pkmn.boosts}"
 
-        # Available moves
-        available_moves_info = "Available moves:\n"
-        if battle.available_moves:
-            for move in battle.available_moves:
-                available_moves_info += f"- {move.id} (Type: {move.type}, BP: {move.base_power}, Acc: {move.accuracy}, PP: {move.current_pp}/{move.max_pp}, Cat: {move.category.name})\n"
-        else:
-             available_moves_info += "- None (Must switch or Struggle)\n"
+        # Available moves (built as a list and joined once)
+        moves_lines = [
+            f"- {m.id} (Type: {m.type}, BP: {m.base_power}, Acc: {m.accuracy}, PP: {m.current_pp}/{m.max_pp}, Cat: {m.category.name})"
+            for m in battle.available_moves
+        ]
+        available_moves_info = "Available moves:\n" + ("\n".join(moves_lines) if moves_lines else "- None (Must switch or Struggle)")
 
         # Available switches
-        available_switches_info = "Available switches:\n"
-        if battle.available_switches:
-            for pkmn in battle.available_switches:
-                 available_switches_info += f"- {pkmn.species} (HP: {pkmn.current_hp_fraction * 100:.1f}%, Status: {pkmn.status.name if pkmn.status else 'None'})\n"
-        else:
-            available_switches_info += "- None\n"
+        switches_lines = [
+            f"- {p.species} (HP: {p.current_hp_fraction * 100:.1f}%, Status: {p.status.name if p.status else 'None'})"
+            for p in battle.available_switches
+        ]
+        available_switches_info = "Available switches:\n" + ("\n".join(switches_lines) if switches_lines else "- None")
 
         # Combine information
-        state_str = f"{active_pkmn_info}\n" \
-                    f"{opponent_pkmn_info}\n\n" \
-                    f"{available_moves_info}\n" \
-                    f"{available_switches_info}\n" \
-                    f"Weather: {battle.weather}\n" \
-                    f"Terrains: {battle.fields}\n" \
-                    f"Your Side Conditions: {battle.side_conditions}\n" \
-                    f"Opponent Side Conditions: {battle.opponent_side_conditions}\n"
-
-        return state_str.strip()
-
-    async def _get_openai_decision(self, battle_state: str) -> dict | None:
-        """Sends state to OpenAI and gets back the function call decision."""
-        system_prompt = (
-            "You are a skilled Pokemon battle AI. Your goal is to win the battle. "
-            "Based on the current battle state, decide the best action: either use an available move or switch to an available Pokémon. "
-            "Consider type matchups, HP, status conditions, field effects, entry hazards, and potential opponent actions. "
-            "Only choose actions listed as available."
+        return (
+            f"{active_pkmn_info}\n"
+            f"{opponent_pkmn_info}\n\n"
+            f"{available_moves_info}\n\n"
+            f"{available_switches_info}\n\n"
+            f"{self._format_environment(battle)}"
+        )
+
+    def _format_environment(self, battle: Battle) -> str:
+        """Formats weather, fields and side conditions, reusing the last string while they are unchanged."""
+        # poke-env mutates these dicts in place, so compare their contents rather than their identities
+        env_key = (
+            tuple(battle.weather.items()),
+            tuple(battle.fields.items()),
+            tuple(battle.side_conditions.items()),
+            tuple(battle.opponent_side_conditions.items()),
         )
-        user_prompt = f"Current Battle State:\n{battle_state}\n\nChoose the best action by calling the appropriate function ('choose_move' or 'choose_switch')."
+        if self._env_cache is not None and self._env_cache[0] == env_key:
+            return self._env_cache[1]
+        env_str = f"Weather: {battle.weather}\n" \
+                  f"Terrains: {battle.fields}\n" \
+                  f"Your Side Conditions: {battle.side_conditions}\n" \
+                  f"Opponent Side Conditions: {battle.opponent_side_conditions}"
+        self._env_cache = (env_key, env_str)
+        return env_str
+
+    async def _get_openai_decision(self, battle_state: str, targets: tuple[str, ...]) -> dict | None:
+        """Sends state to OpenAI and gets back the 'act' tool call arguments."""
+        # Dynamic battle state goes last so everything before it stays cacheable
+        user_prompt = USER_PROMPT_PREFIX + battle_state
 
         try:
-            response = await self.openai_client.chat.completions.create(
+            async with _api_request(
+                self.openai_client,
                 model=self.model,
                 messages=[
-                    {"role": "system", "content": system_prompt},
+                    self._system_msg,
                     {"role": "user", "content": user_prompt},
                 ],
-                functions=self.functions,
-                function_call="auto", # Let the model choose which function to call
-                temperature=0.5, # Adjust for creativity vs consistency
-            )
-            message = response.choices[0].message
-            if message.function_call:
-                function_name = message.function_call.name
+                tools=[build_act_tool(targets)],
+                tool_choice=ACT_TOOL_CHOICE, # Always answer with the 'act' tool, never plain text
+                parallel_tool_calls=False, # Exactly one action per turn
+                max_tokens=64, # A tool call needs ~20 tokens; cap worst-case generation
+                temperature=0.3, # Adjust for creativity vs consistency
+                stream=True, # Stop reading as soon as the function call is complete
+            ) as response:
+                # Accumulate the streamed tool call; arguments are only parsed once it finishes
+                function_name = ""
+                arguments_parts = []
+                try:
+                    async for chunk in response:
+                        if not chunk.choices:
+                            continue
+                        choice = chunk.choices[0]
+                        for tool_call in choice.delta.tool_calls or ():
+                            if tool_call.index != 0 or not tool_call.function:
+                                continue
+                            if tool_call.function.name:
+                                function_name += tool_call.function.name
+                            if tool_call.function.arguments:
+                                arguments_parts.append(tool_call.function.arguments)
+                        if choice.finish_reason is not None:
+                            break
+                finally:
+                    await response.close()
+
+            if function_name:
+                raw_arguments = "".join(arguments_parts)
                 try:
-                    arguments = json.loads(message.function_call.arguments)
+                    arguments = json.loads(raw_arguments)
                     return {"name": function_name, "arguments": arguments}
                 except json.JSONDecodeError:
-                    print(f"Error decoding function call arguments: {message.function_call.arguments}")
+                    logger.warning("Error decoding function call arguments: %s", raw_arguments)
                     return None
             else:
-                # Model decided not to call a function (or generated text instead)
-                print(f"Warning: OpenAI did not return a function call. Response: {message.content}")
+                logger.warning("OpenAI did not return a tool call.")
                 return None
 
+        except _RateLimitWaitTooLong as e:
+            logger.warning("Skipping OpenAI call: %s", e)
+            return None
         except Exception as e:
-            print(f"Error during OpenAI API call: {e}")
+            logger.error("Error during OpenAI API call: %s", e)
             return None
 
-    def _find_move_by_name(self, battle: Battle, move_name: str) -> Move | None:
+    def _find_move_by_name(self, move_idx: dict[str, Move], move_name: str) -> Move | None:
         """Finds the Move object corresponding to the given name."""
-        # Normalize name for comparison (lowercase, remove spaces/hyphens)
-        normalized_name = move_name.lower().replace(" ", "").replace("-", "")
-        for move in battle.available_moves:
-            if move.id == normalized_name: # move.id is already normalized
-                return move
-        # Fallback: try matching against the display name if ID fails (less reliable)
-        for move in battle.available_moves:
-             if move.id == move_name.lower(): # Handle cases like "U-turn" vs "uturn"
-                 return move
-             if move.name.lower() == move_name.lower():
-                return move
-        return None
-
-    def _find_pokemon_by_name(self, battle: Battle, pokemon_name: str) -> Pokemon | None:
+        # move.id is already normalized; normalize the requested name the same way
+        return move_idx.get(move_name.lower().translate(_NORMALIZE_TABLE))
+
+    def _find_pokemon_by_name(self, switch_idx: dict[str, Pokemon], pokemon_name: str) -> Pokemon | None:
         """Finds the Pokemon object corresponding to the given species name."""
-        # Normalize name for comparison
-        normalized_name = pokemon_name.lower()
-        for pkmn in battle.available_switches:
-            if pkmn.species.lower() == normalized_name:
-                return pkmn
-        return None
+        return switch_idx.get(pokemon_name.lower().translate(_NORMALIZE_TABLE))
 
     async def choose_move(self, battle: Battle) -> str:
         """
         Main decision-making function called by poke-env each turn.
         """
-        # 1. Format battle state
+        # 1. Format battle state. The name lookups are a few small dicts, so they are built
+        #    inline: a worker thread would cost more than it saves and would read the
+        #    Battle while poke-env's loop keeps updating it
+        moves = battle.available_moves
+        switches = battle.available_switches
+        move_idx, switch_idx = _build_indices(battle)
         battle_state_str = self._format_battle_state(battle)
-        # print(f"\n--- Turn {battle.turn} ---") # Debugging
-        # print(battle_state_str) # Debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("--- %s turn %s ---\n%s", battle.battle_tag, battle.turn, battle_state_str)
 
-        # 2. Get decision from OpenAI
-        decision = await self._get_openai_decision(battle_state_str)
+        # 2. Reuse the decision for a previously seen position, else ask OpenAI
+        #    (constrained to this turn's legal targets)
+        cache_key = self._decision_cache_key(battle)
+        decision = self._decision_cache.get(cache_key)
+        if decision is not None:
+            self._decision_cache.move_to_end(cache_key)
+        else:
+            targets = (*(m.id for m in moves), *(p.species for p in switches))
+            decision = await self._get_openai_decision(battle_state_str, targets) if targets else None
+
+        # O(1) legality checks instead of list scans with Move/Pokemon __eq__
+        avail_move_ids = frozenset(move_idx)
+        avail_switch_species = frozenset(p.species for p in switches)
 
         # 3. Parse decision and create order
-        if decision:
-            function_name = decision["name"]
+        if decision and decision["name"] == ACT_TOOL_NAME:
             args = decision["arguments"]
-            # print(f"OpenAI Recommended: {function_name} with args {args}") # Debugging
-
-            if function_name == "choose_move":
-                move_name = args.get("move_name")
-                if move_name:
-                    chosen_move = self._find_move_by_name(battle, move_name)
-                    if chosen_move and chosen_move in battle.available_moves:
-                        # print(f"Action: Using move {chosen_move.id}")
-                        return self.create_order(chosen_move)
-                    else:
-                        print(f"Warning: OpenAI chose unavailable/invalid move '{move_name}'. Falling back.")
+            kind = args.get("kind")
+            target = args.get("target")
+            logger.debug("OpenAI recommended: %s %s", kind, target)
+
+            if not target:
+                logger.warning("OpenAI 'act' called without 'target'; falling back")
+            elif kind == "move":
+                chosen_move = self._find_move_by_name(move_idx, target)
+                if chosen_move and chosen_move.id in avail_move_ids:
+                    logger.debug("Action: Using move %s", chosen_move.id)
+                    self._cache_decision(cache_key, decision)
+                    return self.create_order(chosen_move)
                 else:
-                     print(f"Warning: OpenAI 'choose_move' called without 'move_name'. Falling back.")
-
-            elif function_name == "choose_switch":
-                pokemon_name = args.get("pokemon_name")
-                if pokemon_name:
-                    chosen_switch = self._find_pokemon_by_name(battle, pokemon_name)
-                    if chosen_switch and chosen_switch in battle.available_switches:
-                        # print(f"Action: Switching to {chosen_switch.species}")
-                        return self.create_order(chosen_switch)
-                    else:
-                        print(f"Warning: OpenAI chose unavailable/invalid switch '{pokemon_name}'. Falling back.")
+                    logger.warning("OpenAI chose unavailable/invalid move %s; falling back", target)
+            elif kind == "switch":
+                chosen_switch = self._find_pokemon_by_name(switch_idx, target)
+                if chosen_switch and chosen_switch.species in avail_switch_species:
+                    logger.debug("Action: Switching to %s", chosen_switch.species)
+                    self._cache_decision(cache_key, decision)
+                    return self.create_order(chosen_switch)
                 else:
-                    print(f"Warning: OpenAI 'choose_switch' called without 'pokemon_name'. Falling back.")
+                    logger.warning("OpenAI chose unavailable/invalid switch %s; falling back", target)
+            else:
+                logger.warning("OpenAI 'act' called with unknown kind %s; falling back", kind)
 
         # 4. Fallback if API fails, returns invalid action, or no function call
-        print("Fallback: Choosing random move/switch.")
-        # Ensure options exist before choosing randomly
-        available_options = battle.available_moves + battle.available_switches
-        if available_options:
-             # Use the built-in random choice method from Player for fallback
-             return self.choose_random_move(battle)
-        else:
-             # Should only happen if forced to Struggle
-             return self.choose_default_move(battle)
\ No newline at end of file
+        logger.info("Fallback: Choosing random move/switch.")
+        options = moves + switches
+        if options:
+            return self.create_order(random.choice(options))
+        # Should only happen if forced to Struggle
+        return self.choose_default_move(battle)
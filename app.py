@@ -2,162 +2,449 @@
 import gradio as gr
 import asyncio
 import os
-import random
-import traceback
+import json
+import secrets
+import hashlib
+import tempfile
 import logging
-import threading 
-
+import time
+from typing import Final
+try:
+    import fcntl
+except ImportError: # Windows: the suffix file is used without a lock
+    fcntl = None
+
+# Install uvloop before poke_env is imported so every event loop created afterwards
+# (poke-env's own, and the one Gradio's launch() creates) uses it. uvloop is not
+# available on Windows, where the stdlib default (Proactor) loop is kept.
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
 
 from poke_env.player import Player, RandomPlayer
 from poke_env import AccountConfiguration, ServerConfiguration
+from poke_env.concurrency import POKE_LOOP
+from websockets.exceptions import ConnectionClosed
 
 from agents import OpenAIAgent 
 
 # --- Configuration ---
 POKE_SERVER_URL = "wss://jofthomas.com/showdown/websocket"
 POKE_AUTH_URL = "https://jofthomas.com/showdown/action.php"
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 # --- Constants ---
 RANDOM_PLAYER_BASE_NAME = "RandAgent"
 OPENAI_AGENT_BASE_NAME = "OpenAIAgent"
 DEFAULT_BATTLE_FORMAT = "gen9randombattle"
+# Battles each shared agent plays at once, summed over every user of the app
+MAX_CONCURRENT_BATTLES = int(os.getenv("MAX_CONCURRENT_BATTLES", "10"))
+# Showdown reports one pending outgoing challenge per user (updatechallenges' challengeTo), so
+# a shared agent challenges one user at a time. The server confirms a challenge within
+# CHALLENGE_CONFIRM_TIMEOUT; one left unanswered for PENDING_CHALLENGE_EXPIRY is cancelled
+# so a user who ignores it doesn't lock everyone else out of that agent.
+CHALLENGE_CONFIRM_TIMEOUT = 3.0
+PENDING_CHALLENGE_EXPIRY = 60.0
+# How long an invite waits for its agent to be logged in before giving up: short for an
+# agent that has already logged in once (warm), long for one still being created (cold)
+WARM_LOGIN_TIMEOUT = 5.0
+COLD_LOGIN_TIMEOUT = 30.0
+# Clicks only schedule work on poke-env's loop, so two workers keep up; the bounded queue
+# rejects a click flood instead of piling challenges onto the loop
+INVITE_CLICK_CONCURRENCY = 2
+UI_QUEUE_MAX_SIZE = 32
+# Upper bound on sending one challenge (team + /challenge over the websocket), so a stalled
+# connection can't pin an invite task (and its in-flight slot) forever
+INVITE_TIMEOUT_SECONDS = 30.0
+SHUTDOWN_TIMEOUT = 3.0 # Upper bound on disconnecting the shared agents at exit
+# Challenge failures (e.g. a misspelled username) are expected; log their tracebacks only when debugging
+DEBUG_TRACE: Final[bool] = os.environ.get("POKE_DEBUG") == "1"
+# Names are base name + agent index + a 4-hex suffix, which fits Showdown's 18-character limit
+AGENT_SUFFIX_LENGTH = 4
+# One suffix file per deployment (this app's directory), locked by the process using it
+_DEPLOYMENT_ID = hashlib.sha1(os.path.dirname(os.path.abspath(__file__)).encode()).hexdigest()[:8]
+AGENT_SUFFIX_FILE = os.path.join(tempfile.gettempdir(), f"pokemon_vcg_agent_suffix_{_DEPLOYMENT_ID}.json")
 custom_config = ServerConfiguration(POKE_SERVER_URL, POKE_AUTH_URL)
+# Read once at import; the environment doesn't change while the app runs
+_HAS_OPENAI_KEY: bool = bool(os.getenv("OPENAI_API_KEY"))
+
+def _is_valid_suffix(suffix: str) -> bool:
+    """Whether the suffix can go into a Showdown username."""
+    return suffix.isascii() and suffix.isalnum()
+
+# Open, locked handle on AGENT_SUFFIX_FILE; kept for the process's lifetime to hold the lock
+_agent_suffix_handle = None
+
+def _load_agent_suffix() -> str:
+    """
+    Returns the suffix for the agents' usernames: AGENT_SUFFIX from the environment, else the
+    one persisted by an earlier run of this deployment, else a fresh one (persisted for the
+    next run). Keeping the same accounts across restarts avoids Showdown's rate limits on
+    registering new names. The file stays locked while this process runs, so a second instance
+    on the host gets a fresh suffix instead of fighting over the same accounts.
+    """
+    global _agent_suffix_handle
+    suffix = os.getenv("AGENT_SUFFIX", "").strip()[:AGENT_SUFFIX_LENGTH]
+    if suffix:
+        if _is_valid_suffix(suffix):
+            return suffix
+        logger.warning("Ignoring AGENT_SUFFIX=%r: it must be alphanumeric.", suffix)
+    try:
+        f = os.fdopen(os.open(AGENT_SUFFIX_FILE, os.O_RDWR | os.O_CREAT, 0o644), "r+", encoding="utf-8")
+    except OSError as e:
+        logger.warning("Could not open agent suffix file %s: %r", AGENT_SUFFIX_FILE, e)
+        return secrets.token_hex(AGENT_SUFFIX_LENGTH // 2)
+    if fcntl is not None:
+        try:
+            # A per-process lock, so a Gradio reload in this process takes it again
+            fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            logger.warning(
+                "Another process is using the agent names in %s; using a fresh suffix. "
+                "Set AGENT_SUFFIX per instance to keep their names stable.", AGENT_SUFFIX_FILE
+            )
+            return secrets.token_hex(AGENT_SUFFIX_LENGTH // 2)
+    _agent_suffix_handle = f
+    try:
+        suffix = str(json.load(f)["suffix"])[:AGENT_SUFFIX_LENGTH]
+        if _is_valid_suffix(suffix):
+            return suffix
+    except (ValueError, KeyError, TypeError):
+        pass
+    suffix = secrets.token_hex(AGENT_SUFFIX_LENGTH // 2)
+    try:
+        f.seek(0)
+        f.truncate()
+        json.dump({"suffix": suffix}, f)
+        f.flush()
+    except OSError as e:
+        logger.warning("Could not persist agent suffix to %s: %r", AGENT_SUFFIX_FILE, e)
+    return suffix
+
+AGENT_SUFFIX: Final[str] = _load_agent_suffix()
+
+# Per agent type: player class, whether it needs OpenAI, and an account configuration
+# built once here rather than on every activation
+AGENT_CONFIGS: dict[str, dict] = {
+    "Random Player": {"player_class": RandomPlayer, "base_name": RANDOM_PLAYER_BASE_NAME, "requires_openai_key": False},
+    "OpenAI Agent": {"player_class": OpenAIAgent, "base_name": OPENAI_AGENT_BASE_NAME, "requires_openai_key": True},
+}
+for _index, _config in enumerate(AGENT_CONFIGS.values(), start=1):
+    _config["account_configuration"] = AccountConfiguration(
+        f"{_config['base_name']}{_index}{AGENT_SUFFIX}", None
+    )
 
 
 # --- Agent Creation (Async - Required by poke-env) ---
+# One persistent, logged-in player per (agent type, format). Later invites reuse its
+# websocket instead of paying TCP + TLS + websocket upgrade + Showdown login again.
+_player_cache: dict[tuple[str, str], Player] = {}
+_player_cache_lock = asyncio.Lock()
+
+def _is_listening(player: Player) -> bool:
+    """Whether the player's websocket listener is still running (it finishes when the connection dies)."""
+    listener = getattr(player.ps_client, "_listening_coroutine", None)
+    return listener is None or not listener.done()
+
+def _evict_player(cache_key: tuple[str, str], player: Player):
+    """
+    Drops a dead player from the cache. Its replacement reuses the same username, and
+    poke-env adds a StreamHandler to that username's logger for every client, so the
+    old handlers are removed too; otherwise each reconnect would duplicate its log lines.
+    """
+    if _player_cache.get(cache_key) is not player:
+        return
+    del _player_cache[cache_key]
+    player_logger = logging.getLogger(player.username)
+    for handler in list(player_logger.handlers):
+        player_logger.removeHandler(handler)
+
+def _get_live_player(cache_key: tuple[str, str]) -> Player | None:
+    """Returns the cached player for this key, evicting it if its connection has died."""
+    player = _player_cache.get(cache_key)
+    if player is not None and not _is_listening(player):
+        logger.warning("Agent %s lost its connection; a new one will be created.", player.username)
+        _evict_player(cache_key, player)
+        return None
+    return player
+
 async def create_agent_async(agent_type: str, battle_format: str = DEFAULT_BATTLE_FORMAT) -> Player | str:
     """
-    Creates and initializes a SINGLE agent instance with a unique username.
+    Returns the shared agent instance for this type and format, creating it on first
+    use with the account configuration precomputed in AGENT_CONFIGS.
     This function MUST be async because Player initialization involves async network setup.
     Returns the Player object on success, or an error string on failure.
     """
-    logging.info(f"Attempting to create agent of type: {agent_type}")
-    player: Player | None = None
-    error_message: str | None = None
-    username: str = "unknown_agent"
+    cache_key = (agent_type, battle_format)
+    # Lock-free fast path for the steady state; re-checked under the lock so two
+    # concurrent first callers can't both construct a player
+    cached_player = _get_live_player(cache_key)
+    if cached_player is not None:
+        return cached_player
+    async with _player_cache_lock:
+        cached_player = _get_live_player(cache_key)
+        if cached_player is not None:
+            return cached_player
+
+        logger.info("Attempting to create agent of type: %s", agent_type)
+        player: Player | None = None
+        error_message: str | None = None
+        username: str = "unknown_agent"
 
-    agent_suffix = random.randint(10000, 999999)
-
-    try:
-        if agent_type == "Random Player":
-            username = f"{RANDOM_PLAYER_BASE_NAME}{agent_suffix}"
-            account_config = AccountConfiguration(username, None)
-            logging.info(f"Initializing RandomPlayer with username: {username}")
-            player = RandomPlayer(
-                account_configuration=account_config,
-                server_configuration=custom_config,
-                battle_format=battle_format,
-                start_listening=True,
-            )
-        elif agent_type == "OpenAI Agent":
-            if not os.getenv("OPENAI_API_KEY"):
-                 error_message = "Error: Cannot create OpenAI Agent. OPENAI_API_KEY environment variable is missing."
-                 logging.error(error_message)
-                 return error_message
-            username = f"{OPENAI_AGENT_BASE_NAME}{agent_suffix}"
-            account_config = AccountConfiguration(username, None)
-            logging.info(f"Initializing OpenAIAgent with username: {username}")
-            player = OpenAIAgent(
+        try:
+            config = AGENT_CONFIGS.get(agent_type)
+            if config is None:
+                error_message = f"Error: Invalid agent type '{agent_type}' requested."
+                logger.error(error_message)
+                return error_message
+            if config["requires_openai_key"] and not _HAS_OPENAI_KEY:
+                error_message = f"Error: Cannot create {agent_type}. OPENAI_API_KEY environment variable is missing."
+                logger.error(error_message)
+                return error_message
+
+            player_class = config["player_class"]
+            account_config = config["account_configuration"]
+            username = account_config.username
+            logger.info("Initializing %s with username: %s", player_class.__name__, username)
+            player = player_class(
                 account_configuration=account_config,
                 server_configuration=custom_config,
                 battle_format=battle_format,
+                max_concurrent_battles=MAX_CONCURRENT_BATTLES,
                 start_listening=True,
+                # poke-env's default websocket keepalive (20s pings, 20s pong timeout) keeps the
+                # idle shared connection from being dropped by proxies/NAT between invites
             )
-        else:
-            error_message = f"Error: Invalid agent type '{agent_type}' requested."
-            logging.error(error_message)
-            return error_message
 
-        logging.info(f"Agent object ({username}) created successfully.")
-        return player
+            _track_outgoing_challenges(player)
+            logger.info("Agent object (%s) created successfully.", username)
+            _player_cache[cache_key] = player
+            return player
 
-    except Exception as e:
-        error_message = f"Error creating agent {username}: {e}"
-        logging.error(error_message)
-        logging.error(traceback.format_exc())
-        return error_message
+        except Exception as e:
+            logger.exception("Error creating agent %s: %s", username, e)
+            return f"Error creating agent {username}: {e}"
 
 # --- Battle Invitation (Async - Required by poke-env) ---
+def _to_id(name: str) -> str:
+    """Showdown's user id for a name: its lowercase letters and digits."""
+    return "".join(c for c in name.lower() if c.isalnum())
+
+def _track_outgoing_challenges(player: Player):
+    """
+    Records the player's pending outgoing challenge from Showdown's updatechallenges
+    messages, whose challengeTo poke-env itself ignores, before passing them on.
+    """
+    player._challenge_to = None # Id of the user our pending challenge is addressed to
+    player._challenge_confirmed = None # Last challengeTo seen; survives it being accepted
+    player._challenge_sent_at = 0.0
+    player._challenge_updated = asyncio.Event()
+    player._challenge_lock = asyncio.Lock() # One challenge decision at a time per agent
+    handle_update = player.ps_client._update_challenges
+
+    async def update_challenges(split_message: list[str]):
+        try:
+            challenge_to = json.loads(split_message[2]).get("challengeTo") or {}
+        except (IndexError, ValueError, AttributeError):
+            challenge_to = {}
+        player._challenge_to = _to_id(challenge_to.get("to") or "") or None
+        if player._challenge_to:
+            player._challenge_confirmed = player._challenge_to
+        player._challenge_updated.set()
+        await handle_update(split_message)
+
+    player.ps_client._update_challenges = update_challenges
+
+async def _wait_for_challenge_confirmation(player: Player, target_id: str) -> bool:
+    """Waits up to CHALLENGE_CONFIRM_TIMEOUT for Showdown to list the challenge to target_id."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + CHALLENGE_CONFIRM_TIMEOUT
+    while player._challenge_confirmed != target_id:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return False
+        player._challenge_updated.clear()
+        try:
+            await asyncio.wait_for(player._challenge_updated.wait(), timeout=remaining)
+        except asyncio.TimeoutError:
+            return False
+    return True
+
 async def send_battle_invite_async(player: Player, opponent_username: str, battle_format: str) -> str:
     """
-    Sends a challenge using the provided player object.
+    Sends a challenge using the provided player object, unless the shared agent is
+    busy: at its battle cap, or waiting on a recent challenge to someone else.
     This function MUST be async as sending challenges involves network I/O.
-    Returns a status string (success or error message).
+    Returns a status string (success, busy, or unconfirmed).
     """
     if not isinstance(player, Player):
          err_msg = f"Internal Error: Invalid object passed instead of Player: {type(player)}"
-         logging.error(err_msg)
-         # In background thread, we might just log this and exit thread
-         raise TypeError(err_msg) # Raise exception to be caught by the thread runner
+         logger.error(err_msg)
+         raise TypeError(err_msg) # Raise exception to be caught by the invite task
 
-    player_username = getattr(player, 'username', 'unknown_agent')
+    player_username = player.username
+    target_id = _to_id(opponent_username)
 
     try:
-        logging.info(f"Attempting to send challenge from {player_username} to {opponent_username} in format {battle_format}")
-        await player.send_challenges(opponent_username, n_challenges=1)
+        async with player._challenge_lock:
+            # A battle accepted past the cap would block in poke-env's _create_battle and never be played
+            if player._battle_count_queue.full():
+                busy_msg = f"Agent busy: '{player_username}' is already playing {player._battle_count_queue.maxsize} battles."
+                logger.warning(busy_msg)
+                return busy_msg
+            pending = player._challenge_to
+            if pending == target_id:
+                pending_msg = f"A challenge from '{player_username}' to '{opponent_username}' is already pending."
+                logger.info(pending_msg)
+                return pending_msg
+            if pending:
+                if time.monotonic() - player._challenge_sent_at < PENDING_CHALLENGE_EXPIRY:
+                    busy_msg = f"Agent busy: '{player_username}' is waiting for '{pending}' to answer its challenge."
+                    logger.warning(busy_msg)
+                    return busy_msg
+                logger.info("Cancelling the unanswered challenge from %s to %s.", player_username, pending)
+                await player.ps_client.send_message(f"/cancelchallenge {pending}")
+
+            logger.debug("Attempting to send challenge from %s to %s in format %s", player_username, opponent_username, battle_format)
+            player._challenge_confirmed = None
+            # Sent straight through the client: Player.send_challenges would also wait on the
+            # shared player's battle semaphore and battle count, i.e. on every battle it plays
+            await player.ps_client.challenge(opponent_username, battle_format, player.next_team)
+            player._challenge_sent_at = time.monotonic()
+            confirmed = await _wait_for_challenge_confirmation(player, target_id)
+
+        if not confirmed:
+            # Showdown rejects a challenge (unknown user, blocked challenges, ...) with a popup,
+            # which poke-env logs under the agent's name
+            unconfirmed_msg = f"Showdown did not confirm the challenge from '{player_username}' to '{opponent_username}'; see the agent's popup log."
+            logger.warning(unconfirmed_msg)
+            return unconfirmed_msg
         success_msg = f"Battle invitation ({battle_format}) sent to '{opponent_username}' from bot '{player_username}'."
-        logging.info(success_msg)
+        logger.info(success_msg)
         return success_msg # Indicate success
 
     except Exception as e:
-        error_msg = f"Error sending challenge from {player_username} to {opponent_username}: {e}"
-        logging.error(error_msg)
-        logging.error(traceback.format_exc())
-        # Re-raise or return error indication for the thread runner
-        raise e # Raise exception to be caught by the thread runner
-
-
-# --- Background Task Runner (Runs in a separate thread) ---
-def run_invite_in_background(agent_choice: str, target_username: str, battle_format: str):
+        logger.error("Error sending challenge from %s to %s: %s", player_username, opponent_username, e, exc_info=DEBUG_TRACE)
+        raise e # Raise exception to be caught by the invite task
+
+
+# --- Agent Warm-up and Readiness ---
+async def _warm_agent_async(agent_type: str):
+    """Creates one shared agent and waits for its login."""
+    agent_or_error = await create_agent_async(agent_type, DEFAULT_BATTLE_FORMAT)
+    if isinstance(agent_or_error, str):
+        # Error already logged by create_agent_async
+        return
+    if await wait_for_login_async(agent_or_error, COLD_LOGIN_TIMEOUT):
+        agent_or_error._warm = True
+        logger.info("Agent %s is logged in and ready.", agent_or_error.username)
+    else:
+        logger.warning("Agent %s did not log in within %.0fs during warm-up.", agent_or_error.username, COLD_LOGIN_TIMEOUT)
+
+async def warm_agents_async():
+    """Warms every available agent type concurrently; one failing doesn't stop the others."""
+    agent_types = [
+        agent_type for agent_type, config in AGENT_CONFIGS.items()
+        if _HAS_OPENAI_KEY or not config["requires_openai_key"]
+    ]
+    results = await asyncio.gather(*(_warm_agent_async(agent_type) for agent_type in agent_types), return_exceptions=True)
+    for agent_type, result in zip(agent_types, results):
+        if isinstance(result, BaseException):
+            logger.error("Warm-up of %s failed: %r", agent_type, result)
+
+def schedule_agent_warmup():
     """
-    This function runs in a separate thread for each invite request.
-    It sets up and runs the asyncio operations needed for one invite.
+    Starts warming the shared agents on poke-env's loop without waiting for them,
+    moving the websocket handshake and Showdown login out of the first click.
     """
-    thread_name = threading.current_thread().name
-    logging.info(f"Background thread '{thread_name}' started for {agent_choice} vs {target_username}.")
-
-    async def _run_async_challenge_steps():
-        """The async steps to be run via asyncio.run() in this thread."""
-        agent_or_error = await create_agent_async(agent_choice, battle_format)
+    asyncio.run_coroutine_threadsafe(warm_agents_async(), POKE_LOOP)
 
-        if isinstance(agent_or_error, str):
-            # Agent creation failed, log the error message from create_agent_async
-            logging.error(f"[{thread_name}] Agent creation failed: {agent_or_error}")
-            # No further action needed in this thread
-            return
+async def wait_for_login_async(player: Player, timeout: float) -> bool:
+    """Waits up to `timeout` seconds for the player's Showdown login. Returns whether it completed."""
+    try:
+        await asyncio.wait_for(player.ps_client.logged_in.wait(), timeout=timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
 
-        player_instance: Player = agent_or_error
-        player_username = getattr(player_instance, 'username', 'agent')
-        logging.info(f"[{thread_name}] Agent {player_username} created, proceeding to challenge {target_username}.")
+# --- Invite Task (Runs on poke-env's loop) ---
+# In-flight invites keyed by (agent type, opponent), so duplicate clicks share one run
+_inflight_invites: dict[tuple[str, str], asyncio.Future] = {}
 
-        try:
-            result = await send_battle_invite_async(player_instance, target_username, battle_format)
-            # Log the success message from send_battle_invite_async
-            logging.info(f"[{thread_name}] Challenge result: {result}")
-        except Exception as invite_error:
-            # Log errors from send_battle_invite_async
-            # Error message/traceback already logged inside send_battle_invite_async
-            logging.error(f"[{thread_name}] Failed to send challenge from {player_username} to {target_username}. Error: {invite_error}")
-        finally:
-            pass
+async def run_invite_async(agent_choice: str, target_username: str, battle_format: str):
+    """
+    Runs the invite, or joins the identical one already in flight.
+    The lookup and insert happen without an await in between, so on the single
+    poke-env loop no second caller can slip past the check.
+    """
+    key = (agent_choice, target_username.lower())
+    inflight = _inflight_invites.get(key)
+    if inflight is None:
+        inflight = asyncio.ensure_future(_run_invite_async(agent_choice, target_username, battle_format))
+        _inflight_invites[key] = inflight
+        inflight.add_done_callback(lambda _: _inflight_invites.pop(key, None))
+    else:
+        logger.info("Invite from %s to %s already in flight; joining it.", agent_choice, target_username)
+    # Shield so one caller being cancelled doesn't cancel the shared run
+    return await asyncio.shield(inflight)
+
+async def _run_invite_async(agent_choice: str, target_username: str, battle_format: str):
+    """Gets the shared agent and sends one challenge with it."""
+    agent_or_error = await create_agent_async(agent_choice, battle_format)
+
+    if isinstance(agent_or_error, str):
+        # Agent creation failed, log the error message from create_agent_async
+        logger.error("Agent creation failed: %s", agent_or_error)
+        # No further action needed for this invite
+        return
+
+    player_instance: Player = agent_or_error
+    player_username = player_instance.username
+    login_timeout = WARM_LOGIN_TIMEOUT if getattr(player_instance, "_warm", False) else COLD_LOGIN_TIMEOUT
+    if not await wait_for_login_async(player_instance, login_timeout):
+        logger.error("Agent %s did not log in within %.0fs; not challenging %s.", player_username, login_timeout, target_username)
+        return
+    player_instance._warm = True
+    logger.info("Agent %s ready, proceeding to challenge %s.", player_username, target_username)
 
     try:
-        asyncio.run(_run_async_challenge_steps())
-        logging.info(f"Background thread '{thread_name}' finished successfully for {target_username}.")
-    except RuntimeError as e:
-         logging.error(f"[{thread_name}] asyncio RuntimeError: {e}")
-         logging.error(traceback.format_exc())
-    except Exception as e:
-        logging.error(f"[{thread_name}] Unexpected error in background task: {e}")
-        logging.error(traceback.format_exc())
-
-# --- Gradio Interface Logic (Starts the background thread) ---
-def start_invite_thread(agent_choice: str, username: str) -> str:
+        result = await asyncio.wait_for(
+            send_battle_invite_async(player_instance, target_username, battle_format),
+            timeout=INVITE_TIMEOUT_SECONDS,
+        )
+        # Log the success message from send_battle_invite_async
+        logger.info("Challenge result: %s", result)
+    except asyncio.TimeoutError:
+        logger.error("Sending the challenge from %s to %s did not complete within %.0fs.", player_username, target_username, INVITE_TIMEOUT_SECONDS)
+    except ConnectionClosed as invite_error:
+        # The shared agent's connection is gone: drop it so the next invite builds a fresh one
+        _evict_player((agent_choice, battle_format), player_instance)
+        logger.error("Connection of %s closed while challenging %s; agent will be recreated. Error: %s", player_username, target_username, invite_error)
+    except Exception as invite_error:
+        # Anything else is treated as transient: keep the logged-in agent for the next invite
+        # Error message (and traceback, with POKE_DEBUG=1) already logged inside send_battle_invite_async
+        logger.error("Failed to send challenge from %s to %s. Error: %s", player_username, target_username, invite_error)
+
+def _log_invite_outcome(future, target_username: str):
+    """Done-callback for invite futures: surfaces errors nothing else caught."""
+    if future.cancelled():
+        logger.warning("Invite task for %s was cancelled.", target_username)
+        return
+    error = future.exception()
+    if error is not None:
+        logger.error("Unexpected error in invite task for %s: %s", target_username, error, exc_info=error)
+    else:
+        logger.info("Invite task finished successfully for %s.", target_username)
+
+# --- Gradio Interface Logic (Schedules the invite on poke-env's loop) ---
+def start_invite(agent_choice: str, username: str) -> str:
     """
     Handles the Gradio button click (Synchronous, but FAST).
-    Performs basic validation and starts a background thread to handle
-    the actual agent creation and invitation process.
+    Performs basic validation and submits the agent creation and invitation
+    process to poke-env's event loop, where the shared players already live.
     Returns an immediate status message to Gradio.
     """
     username_clean = username.strip()
@@ -166,27 +453,57 @@ def start_invite_thread(agent_choice: str, username: str) -> str:
     if not agent_choice:
         return "⚠️ Please select an agent type."
 
-    logging.info(f"Received request: Agent={agent_choice}, Opponent={username_clean}. Starting background thread.")
+    logger.info("Received request: Agent=%s, Opponent=%s. Scheduling on poke-env loop.", agent_choice, username_clean)
 
-    # Create and start the background thread
-    thread = threading.Thread(
-        target=run_invite_in_background,
-        args=(agent_choice, username_clean, DEFAULT_BATTLE_FORMAT),
-        daemon=True # Set as daemon so threads don't block app exit
+    future = asyncio.run_coroutine_threadsafe(
+        run_invite_async(agent_choice, username_clean, DEFAULT_BATTLE_FORMAT),
+        POKE_LOOP,
     )
-    thread.start()
+    future.add_done_callback(lambda f: _log_invite_outcome(f, username_clean))
 
     # Return immediately to Gradio UI
     return f"✅ Invite process for '{username_clean}' started in background. Check Pokémon Showdown and logs for status."
 
 
+# --- Shutdown ---
+async def _disconnect_agent(player: Player):
+    """Closes one agent's websocket, tolerating a peer that is already gone."""
+    try:
+        await asyncio.wait_for(player.ps_client.stop_listening(), timeout=2.0)
+    except (ConnectionClosed, asyncio.TimeoutError, AttributeError):
+        pass
+
+async def disconnect_agents_async():
+    """Closes the websocket of every shared agent."""
+    players = list(_player_cache.values())
+    _player_cache.clear()
+    await asyncio.gather(*(_disconnect_agent(player) for player in players))
+
+def shutdown_agents():
+    """
+    Disconnects the shared agents on poke-env's loop and waits for it to finish,
+    bounded by SHUTDOWN_TIMEOUT, instead of sleeping and hoping it did.
+    """
+    cleanup = asyncio.run_coroutine_threadsafe(
+        asyncio.wait_for(disconnect_agents_async(), timeout=SHUTDOWN_TIMEOUT), POKE_LOOP
+    )
+    try:
+        cleanup.result(timeout=SHUTDOWN_TIMEOUT + 1)
+        logger.info("Shared agents disconnected.")
+    except Exception as e:
+        logger.warning("Agent cleanup did not complete cleanly: %r", e)
+
 # --- Gradio UI Definition ---
-# [ main_app function remains the same, but the button click now calls start_invite_thread ]
-def main_app():
-    """Creates and returns the Gradio application interface."""
+IFRAME_CODE: Final[str] = """
+        <iframe
+            src="https://jofthomas.com/play.pokemonshowdown.com/testclient.html"
+            width="100%" height="800" style="border: none;" referrerpolicy="no-referrer">
+        </iframe>
+        """
 
-    agent_options = ["Random Player"]
-    agent_options.append("OpenAI Agent")
+def _build_demo() -> gr.Blocks:
+    """Builds the Gradio application interface. Called once, at import."""
+    agent_options = list(AGENT_CONFIGS)
 
     # Use a more descriptive title if possible
     with gr.Blocks(title="Pokemon Showdown Multi-Challenger") as demo:
@@ -196,7 +513,7 @@ def main_app():
             "2. Select an agent type.\n"
             "3. Enter **your** Showdown username (the one you are logged in with below).\n"
             "4. Click 'Send Battle Invitation'. You can click multiple times for different users.\n\n"
-            "A temporary bot will be created *in the background* to send the challenge in `gen9randombattle` format."
+            "A bot will send the challenge *in the background* in `gen9randombattle` format."
         )
 
         with gr.Row():
@@ -208,23 +525,30 @@ def main_app():
             )
             #variant="primary"
             battle_button = gr.Button("Send Battle Invitation",  scale=1)
-        gr.HTML("""
-        <iframe
-            src="https://jofthomas.com/play.pokemonshowdown.com/testclient.html"
-            width="100%" height="800" style="border: none;" referrerpolicy="no-referrer">
-        </iframe>
-        """)
+        gr.HTML(IFRAME_CODE)
 
         # *** IMPORTANT: Update the click handler ***
         battle_button.click(
-            fn=start_invite_thread, # Calls the function that starts the thread
+            fn=start_invite, # Schedules the invite on poke-env's loop
             inputs=[agent_dropdown, name_input],
+            concurrency_limit=INVITE_CLICK_CONCURRENCY,
         )
 
     return demo
 
+# Built once and reused; the module-level name also lets `gradio app.py` hot-reload find it
+demo = _build_demo()
+
+def main_app():
+    """Returns the Gradio application interface."""
+    return demo
+
 # --- Application Entry Point ---
-# [ if __name__ == "__main__": block remains the same ]
 if __name__ == "__main__":
-    app = main_app()
-    app.launch()
\ No newline at end of file
+    # Configured only when run as the app, so importing this module leaves logging to the host
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+    schedule_agent_warmup()
+    try:
+        demo.queue(max_size=UI_QUEUE_MAX_SIZE).launch()
+    finally:
+        shutdown_agents()
\ No newline at end of file
@@ -1,30 +1,42 @@
-toolsList=[
-            {
-                "name": "choose_move",
-                "description": "Selects and executes an available attacking or status move.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "move_name": {
-                            "type": "string",
-                            "description": "The exact name of the move to use (e.g., 'Thunderbolt', 'Swords Dance'). Must be one of the available moves.",
-                        },
+from functools import lru_cache
+
+ACT_TOOL_NAME = "act"
+ACT_TOOL_CHOICE = {"type": "function", "function": {"name": ACT_TOOL_NAME}}
+
+# Parts of the schema that don't depend on the turn, built once at import
+_ACT_TOOL_DESCRIPTION = "Uses an available move or switches to an available Pokémon from the bench."
+_KIND_PROPERTY = {
+    "type": "string",
+    "enum": ["move", "switch"],
+    "description": "'move' to use an available move, 'switch' to switch to an available Pokémon.",
+}
+_TARGET_DESCRIPTION = "The move id or Pokémon species to act with. Must be one of the available moves or switches."
+_REQUIRED = ["kind", "target"]
+
+@lru_cache(maxsize=256)
+def build_act_tool(targets: tuple[str, ...]) -> dict:
+    """
+    Builds the single 'act' tool for this turn.
+    `target` is constrained to the exact legal move ids and switch species, so the
+    model can only emit one short, valid string. Cached per target set, which repeats
+    across turns; callers must treat the returned dict as read-only.
+    """
+    return {
+        "type": "function",
+        "function": {
+            "name": ACT_TOOL_NAME,
+            "description": _ACT_TOOL_DESCRIPTION,
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "kind": _KIND_PROPERTY,
+                    "target": {
+                        "type": "string",
+                        "enum": list(targets),
+                        "description": _TARGET_DESCRIPTION,
                     },
-                    "required": ["move_name"],
                 },
+                "required": _REQUIRED,
             },
-            {
-                "name": "choose_switch",
-                "description": "Selects an available Pokémon from the bench to switch into.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "pokemon_name": {
-                            "type": "string",
-                            "description": "The exact name of the Pokémon species to switch to (e.g., 'Pikachu', 'Charizard'). Must be one of the available switches.",
-                        },
-                    },
-                    "required": ["pokemon_name"],
-                },
-            },
-        ]
\ No newline at end of file
+        },
+    }